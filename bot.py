@@ -1,20 +1,36 @@
 
+import io
 import os
+import re
 import sqlite3
-from datetime import datetime, timedelta
-import pytz
-from PIL import Image, ImageDraw, ImageFont
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from zoneinfo import available_timezones
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # no Pillow: /report falls back to a text summary
+    Image = ImageDraw = ImageFont = None
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 import asyncio
 
 # ----------------- Config -----------------
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, "data", "bot.db")
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+# All paths are resolved once at import; handlers never rebuild them
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+DB_PATH = os.path.join(DATA_DIR, "bot.db")
+ASSETS_DIR = os.path.join(BASE_DIR, "assets")
+LOGO_PATH = os.path.join(ASSETS_DIR, "logo.png")
+os.makedirs(DATA_DIR, exist_ok=True)
 
 DEFAULT_TZ = "Asia/Yekaterinburg"
+# lowercase -> canonical IANA name; like pytz.timezone(), lookups ignore case
+_TZ_BY_LOWER = {z.lower(): z for z in available_timezones()}
 POINTS_TRAIN = 2
 POINTS_SALE = 10
 
@@ -24,160 +40,413 @@ COLOR_TEXT = (34,34,34)
 COLOR_ACCENT = (46,125,50) # green
 COLOR_GOLD = (212,175,55)
 
+# Card labels are plain Cyrillic/Latin: BASIC layout skips Raqm/HarfBuzz shaping.
+# A font bundled in assets/ wins over the system one, so cards look the same on
+# hosts without DejaVu installed.
+def _safe_font(name:str, size:int):
+    for path in (os.path.join(ASSETS_DIR, name), name):
+        try:
+            return ImageFont.truetype(path, size, layout_engine=ImageFont.Layout.BASIC)
+        except (OSError, ImportError):
+            continue
+    return ImageFont.load_default()
+
+def _font_variant(font, size:int):
+    # reuse the already-parsed face for another size of the same font
+    return font.font_variant(size=size) if isinstance(font, ImageFont.FreeTypeFont) else font
+
+# Parsed once: truetype() re-reads the TTF and builds a FreeType face on every call
+if ImageFont is not None:
+    _F_BIG = _safe_font("DejaVuSans-Bold.ttf", 64)
+    _F_MID = _safe_font("DejaVuSans.ttf", 36)
+    _F_SM  = _font_variant(_F_MID, 28)
+else:
+    _F_BIG = _F_MID = _F_SM = None
+
+def _read_logo()->bytes|None:
+    try:
+        with open(LOGO_PATH, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+# Raw PNG, read once: sent as-is on /start and decoded for the card thumbnail
+_LOGO_BYTES = _read_logo()
+
+def _load_logo_thumb(h:int=96):
+    if _LOGO_BYTES is None:
+        return None
+    try:
+        lg = Image.open(io.BytesIO(_LOGO_BYTES)).convert("RGBA")
+        ratio = h / lg.height
+        lg = lg.resize((int(lg.width*ratio), h), Image.LANCZOS)
+    except Exception:
+        return None
+    # Fully opaque logo: paste as RGB without a mask and skip per-pixel blending
+    if lg.getchannel("A").getextrema() == (255, 255):
+        return lg.convert("RGB")
+    return lg
+
+# Decoded and resized once; None disables the logo on the card
+_LOGO_THUMB = _load_logo_thumb() if Image is not None else None
+
 # ----------------- DB -----------------
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys=ON")
+# Statements run on every update. The connection's statement cache is keyed by
+# SQL text, so each one is prepared once per process.
+SQL_ENSURE_USER = "INSERT OR IGNORE INTO users(user_id, created_at, tz, sale_threshold) VALUES(?, ?, ?, ?)"
+SQL_GET_SETTINGS = "SELECT tz, sale_threshold, notify FROM users WHERE user_id=?"
+SQL_SET_TZ = "UPDATE users SET tz=? WHERE user_id=?"
+SQL_SET_THRESHOLD = "UPDATE users SET sale_threshold=? WHERE user_id=?"
+SQL_SET_NOTIFY = "UPDATE users SET notify=? WHERE user_id=?"
+SQL_CLEAR_SPORT_TYPES = "DELETE FROM sport_types WHERE user_id=?"
+SQL_INSERT_SPORT_TYPE = "INSERT OR IGNORE INTO sport_types(user_id,name) VALUES(?,?)"
+SQL_INSERT_LOG = "INSERT INTO logs(user_id, kind, value, payload, created_at, ts) VALUES(?,?,?,?,?,?)"
+SQL_ALL_SETTINGS = "SELECT user_id, tz, sale_threshold, notify FROM users"
+SQL_ALL_DAILY_STATS = ("SELECT user_id, ts/86400 AS day, kind, COUNT(*), COALESCE(SUM(value),0) FROM logs "
+                       "WHERE user_id IN (SELECT user_id FROM users) AND ts>=? "
+                       "GROUP BY user_id, day, kind ORDER BY user_id, day")
+SQL_DAILY_STATS = ("SELECT ts/86400 AS day, kind, COUNT(*), COALESCE(SUM(value),0) FROM logs "
+                   "WHERE user_id=? AND ts>=? GROUP BY day, kind ORDER BY day")
+
+_CONN: sqlite3.Connection | None = None
+# Serializes writers on the shared connection: handlers run on the event loop
+# while stats and cards run in worker threads.
+_DB_LOCK = threading.RLock()
+
+# One connection for the whole process: opening the file per call throws away
+# the page cache and pays open/close syscalls on every handler.
+def get_conn()->sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        with _DB_LOCK:
+            if _CONN is None:
+                _CONN = _open_conn()
+    return _CONN
+
+def _open_conn()->sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.executescript(
+        "PRAGMA foreign_keys=ON;"
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-64000;"
+        "PRAGMA mmap_size=268435456;"
+    )
     return conn
 
 def init_db():
     conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        user_id INTEGER PRIMARY KEY,
-        created_at TEXT,
-        tz TEXT,
-        notify INTEGER DEFAULT 1,
-        sale_threshold INTEGER DEFAULT 0
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS sport_types(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        name TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS sport_schedule(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        type_id INTEGER,
-        dow INTEGER,
-        at_time TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS logs(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        kind TEXT,
-        value INTEGER,
-        payload TEXT,
-        created_at TEXT
-    )
-    """)
-    conn.commit(); conn.close()
+    # Schema is versioned with PRAGMA user_version: an up-to-date database costs one
+    # pragma read, and each future change appends an `if version < N:` block.
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # v1: base tables; upgrades pre-versioning databases in place
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+            user_id INTEGER PRIMARY KEY,
+            created_at TEXT,
+            tz TEXT,
+            notify INTEGER DEFAULT 1,
+            sale_threshold INTEGER DEFAULT 0
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS sport_types(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS sport_schedule(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            type_id INTEGER,
+            dow INTEGER,
+            at_time TEXT
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS logs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            kind TEXT,
+            value INTEGER,
+            payload TEXT,
+            created_at TEXT,
+            ts INTEGER
+        )
+        """)
+        # ts is created_at as unix seconds: 8-byte index keys and integer range compares
+        cols = {row[1] for row in cur.execute("PRAGMA table_info(logs)")}
+        if "ts" not in cols:
+            cur.execute("ALTER TABLE logs ADD COLUMN ts INTEGER")
+            cur.execute("UPDATE logs SET ts=CAST(strftime('%s', created_at) AS INTEGER)")
+        cur.execute("DROP INDEX IF EXISTS idx_logs_user_time")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_ts ON logs(user_id, ts)")
+        # One row per (user, type name); also serves onboarding's DELETE ... WHERE user_id=?
+        # repoint schedules at the surviving row before dropping duplicates
+        cur.execute("UPDATE sport_schedule SET type_id=(SELECT MIN(t2.id) FROM sport_types t1 "
+                    "JOIN sport_types t2 USING(user_id, name) WHERE t1.id=sport_schedule.type_id) "
+                    "WHERE type_id IN (SELECT id FROM sport_types)")
+        cur.execute("DELETE FROM sport_types WHERE id NOT IN "
+                    "(SELECT MIN(id) FROM sport_types GROUP BY user_id, name)")
+        cur.execute("DROP INDEX IF EXISTS idx_sport_types_user")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sport_types_user_name ON sport_types(user_id, name)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sport_schedule_user ON sport_schedule(user_id)")
+        cur.execute("PRAGMA user_version=1")
+    if version < 2:
+        # v2: covering index; the daily aggregate query reads only the index
+        cur.execute("DROP INDEX IF EXISTS idx_logs_user_ts")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_ts_kind ON logs(user_id, ts, kind, value)")
+        cur.execute("PRAGMA user_version=2")
+    conn.commit()
 
 def ensure_user(uid: int):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id=?", (uid,))
-    if not cur.fetchone():
-        cur.execute(
-            "INSERT INTO users(user_id, created_at, tz, sale_threshold) VALUES(?, ?, ?, ?)",
-            (uid, datetime.utcnow().isoformat(), DEFAULT_TZ, 0)
-        )
+    with _DB_LOCK:
+        conn = get_conn(); cur = conn.cursor()
+        cur.execute(SQL_ENSURE_USER, (uid, utc_iso(), DEFAULT_TZ, 0))
         conn.commit()
-    conn.close()
+
+# Per-user settings change a handful of times per user, but the sale threshold is
+# read on every logged sale: keep them in-process and drop the entry on UPDATE.
+@dataclass
+class UserSettings:
+    tz: str
+    sale_threshold: int
+    notify: bool
+
+_USER_CACHE: dict[int, UserSettings] = {}
+
+def get_settings(uid:int)->UserSettings:
+    st = _USER_CACHE.get(uid)
+    if st is not None:
+        return st
+    with _DB_LOCK:
+        conn=get_conn(); cur=conn.cursor()
+        cur.execute(SQL_GET_SETTINGS, (uid,))
+        row = cur.fetchone()
+        st = _settings_from_row(*row) if row else UserSettings(DEFAULT_TZ, 0, True)
+        _USER_CACHE[uid] = st
+    return st
+
+def _settings_from_row(tz:str|None, thr:int|None, notify:int|None)->UserSettings:
+    return UserSettings(tz or DEFAULT_TZ, int(thr) if thr is not None else 0, notify != 0)
 
 def get_tz(uid:int)->str:
-    conn=get_conn(); cur=conn.cursor()
-    cur.execute("SELECT tz FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row and row[0] else DEFAULT_TZ
+    return get_settings(uid).tz
 
 def get_sale_threshold(uid:int)->int:
-    conn=get_conn(); cur=conn.cursor()
-    cur.execute("SELECT sale_threshold FROM users WHERE user_id=?", (uid,))
-    row = cur.fetchone(); conn.close()
-    return int(row[0]) if row and row[0] is not None else 0
+    return get_settings(uid).sale_threshold
 
 def set_sale_threshold(uid:int, val:int):
-    conn=get_conn(); cur=conn.cursor()
-    cur.execute("UPDATE users SET sale_threshold=? WHERE user_id=?", (val, uid))
-    conn.commit(); conn.close()
+    with _DB_LOCK:
+        conn=get_conn(); cur=conn.cursor()
+        cur.execute(SQL_SET_THRESHOLD, (val, uid))
+        conn.commit()
+        _USER_CACHE.pop(uid, None)
+
+def set_tz(uid:int, tz:str):
+    with _DB_LOCK:
+        conn=get_conn(); cur=conn.cursor()
+        cur.execute(SQL_SET_TZ, (tz, uid))
+        conn.commit()
+        _USER_CACHE.pop(uid, None)
+
+def set_notify(uid:int, on:bool):
+    with _DB_LOCK:
+        conn=get_conn(); cur=conn.cursor()
+        cur.execute(SQL_SET_NOTIFY, (1 if on else 0, uid))
+        conn.commit()
+        _USER_CACHE.pop(uid, None)
+
+def set_sport_types(uid:int, types:list[str]):
+    with _DB_LOCK:
+        conn=get_conn()
+        with conn:  # delete + inserts share one transaction / one fsync
+            conn.execute(SQL_CLEAR_SPORT_TYPES, (uid,))
+            conn.executemany(SQL_INSERT_SPORT_TYPE, [(uid, name) for name in types])
 
 # ----------------- Helpers -----------------
+_ISO_LAST = (-1, "")
+
+# created_at strings: logs landing in the same second reuse one formatted value
+def utc_iso(ts:int|None=None)->str:
+    global _ISO_LAST
+    if ts is None:
+        ts = int(time.time())
+    last = _ISO_LAST
+    if last[0] != ts:
+        last = _ISO_LAST = (ts, datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds"))
+    return last[1]
+
 def fmt_money(v:int)->str:
     s = f"{v:,}".replace(",", " ")
     return s + " ₽"
 
+# log kind -> stats field fed by COUNT(*) / by SUM(value)
+_STAT_COUNT = {"sport": "sport", "call": "calls", "act": "acts", "sale": "sales"}
+_STAT_SUM = {"sale": "cash", "sleep": "sleep", "med": "med", "read": "read"}
+
+def _empty_stats()->dict:
+    return {"sport":0, "calls":0, "acts":0, "sales":0, "cash":0, "sleep":0, "med":0, "read":0}
+
+def _add_stats(out:dict, kind:str, cnt:int, total:int):
+    if kind in _STAT_COUNT: out[_STAT_COUNT[kind]] += cnt
+    if kind in _STAT_SUM: out[_STAT_SUM[kind]] += total
+
+# In-memory per-user daily aggregates, so /stats and /report never scan logs.
+# uid -> deque of (utc_day, stats) oldest first, covering the last AGG_DAYS days.
+# Filled from the DB on first read and bumped by log_action afterwards, which
+# holds as long as a single bot process owns the database.
+AGG_DAYS = 30
+_AGG: dict[int, deque] = {}
+_AGG_LOCK = threading.Lock()
+
+def _today()->int:
+    return int(time.time()) // 86400
+
+def _bucket_add(buckets:deque, day:int, kind:str, cnt:int, total:int):
+    # rows arrive in day order, so a new day is always appended on the right
+    if not buckets or buckets[-1][0] != day:
+        buckets.append((day, _empty_stats()))
+    _add_stats(buckets[-1][1], kind, cnt, total)
+
+def _agg_buckets(uid:int)->deque:
+    # caller holds _AGG_LOCK; _DB_LOCK is taken after it, as everywhere else
+    first = _today() - AGG_DAYS + 1
+    buckets = _AGG.get(uid)
+    if buckets is None:
+        with _DB_LOCK:
+            conn=get_conn(); cur=conn.cursor()
+            cur.execute(SQL_DAILY_STATS, (uid, first*86400))
+            rows = cur.fetchall()
+        buckets = _AGG[uid] = deque()
+        for day, kind, cnt, total in rows:
+            _bucket_add(buckets, day, kind, cnt, total)
+    while buckets and buckets[0][0] < first:
+        buckets.popleft()
+    return buckets
+
+# Startup warm-up: every user's settings and aggregates in two queries instead of
+# one lazy load per user on their first command after a restart.
+def warm_caches():
+    first = _today() - AGG_DAYS + 1
+    with _AGG_LOCK, _DB_LOCK:
+        conn=get_conn(); cur=conn.cursor()
+        cur.execute(SQL_ALL_SETTINGS)
+        for uid, tz, thr, notify in cur.fetchall():
+            _USER_CACHE[uid] = _settings_from_row(tz, thr, notify)
+            _AGG[uid] = deque()
+        cur.execute(SQL_ALL_DAILY_STATS, (first*86400,))
+        for uid, day, kind, cnt, total in cur.fetchall():
+            _bucket_add(_AGG.setdefault(uid, deque()), day, kind, cnt, total)
+
 def log_action(uid:int, kind:str, value:int|None=None, payload:str|None=None):
-    conn=get_conn(); cur=conn.cursor()
-    cur.execute("INSERT INTO logs(user_id, kind, value, payload, created_at) VALUES(?,?,?,?,?)",
-                (uid, kind, value, payload, datetime.utcnow().isoformat()))
-    conn.commit(); conn.close()
+    log_actions(uid, [(kind, value, payload, None)])
+
+# Batch form of log_action for imports: rows are (kind, value, payload, ts),
+# ts=None meaning now. All rows go through one executemany and one commit.
+def log_actions(uid:int, rows:list[tuple]):
+    now = int(time.time())
+    today = now // 86400
+    recs = [(uid, kind, value, payload, utc_iso(now if ts is None else ts), now if ts is None else ts)
+            for kind, value, payload, ts in rows]
+    with _AGG_LOCK, _DB_LOCK:
+        conn=get_conn()
+        with conn:
+            conn.executemany(SQL_INSERT_LOG, recs)
+        buckets = _AGG.get(uid)
+        if buckets is None:
+            return
+        if any(r[5] // 86400 != today for r in recs):
+            # backdated rows: reload this user's buckets on next read
+            _AGG.pop(uid, None)
+            return
+        for r in recs:
+            _bucket_add(buckets, today, r[1], 1, r[2] or 0)
 
+# Windows are whole UTC days (today plus the days-1 before it), days <= AGG_DAYS
 def get_stats(uid:int, days:int):
-    since = datetime.utcnow() - timedelta(days=days)
-    conn=get_conn(); cur=conn.cursor()
-    cur.execute("SELECT kind, value, created_at FROM logs WHERE user_id=? AND created_at>=?",
-                (uid, since.isoformat()))
-    rows = cur.fetchall(); conn.close()
-    out = {"sport":0, "calls":0, "acts":0, "sales":0, "cash":0, "sleep":0, "med":0, "read":0}
-    for k,v,ts in rows:
-        if k=="sport": out["sport"] += 1
-        elif k=="call": out["calls"] += 1
-        elif k=="act": out["acts"] += 1
-        elif k=="sale":
-            out["sales"] += 1
-            out["cash"] += (v or 0)
-        elif k=="sleep": out["sleep"] += (v or 0)
-        elif k=="med": out["med"] += (v or 0)
-        elif k=="read": out["read"] += (v or 0)
-    return out
+    return get_stats_pair(uid, days, days)[0]
+
+def get_stats_pair(uid:int, short:int=7, long:int=30):
+    today = _today()
+    out_s, out_l = _empty_stats(), _empty_stats()
+    with _AGG_LOCK:
+        for day, st in _agg_buckets(uid):
+            for dst, days in ((out_s, short), (out_l, long)):
+                if day > today - days:
+                    for k, v in st.items():
+                        dst[k] += v
+    return out_s, out_l
 
 # ----------------- Card -----------------
-def render_card(uid:int, path:str)->str:
-    s7 = get_stats(uid, 7)
-    s30 = get_stats(uid, 30)
-
+def _build_card_base():
     img = Image.new("RGB", (CARD_W, CARD_H), COLOR_BG)
     d = ImageDraw.Draw(img)
-    try:
-        f_big = ImageFont.truetype("DejaVuSans-Bold.ttf", 64)
-        f_mid = ImageFont.truetype("DejaVuSans.ttf", 36)
-        f_sm  = ImageFont.truetype("DejaVuSans.ttf", 28)
-    except:
-        f_big = f_mid = f_sm = ImageFont.load_default()
 
     # Logo
-    try:
-        logo_path = os.path.join(BASE_DIR, "assets", "logo.png")
-        lg = Image.open(logo_path).convert("RGBA")
-        h = 96; ratio = h / lg.height
-        lg = lg.resize((int(lg.width*ratio), h))
-        img.paste(lg, (36, 28), lg)
-    except Exception:
-        pass
+    if _LOGO_THUMB is not None:
+        mask = _LOGO_THUMB if _LOGO_THUMB.mode == "RGBA" else None
+        img.paste(_LOGO_THUMB, (36, 28), mask)
 
-    d.text((48, 140), "Спутник дня — отчёт", fill=COLOR_TEXT, font=f_big)
+    d.text((48, 140), "Спутник дня — отчёт", fill=COLOR_TEXT, font=_F_BIG)
     d.line((48, 210, CARD_W-48, 210), fill=COLOR_ACCENT, width=4)
 
-    # 7 days
-    y = 250
-    d.text((48, y), "За 7 дней", fill=COLOR_TEXT, font=f_mid)
-    d.text((300, y), f"Спорт: {s7['sport']} • Продаж: {s7['sales']} • Касса: {fmt_money(s7['cash'])}", fill=COLOR_TEXT, font=f_mid)
-    d.line((48, y+40, CARD_W-48, y+40), fill=COLOR_ACCENT, width=2)
+    for y, label in ((250, "За 7 дней"), (320, "За 30 дней")):
+        d.text((48, y), label, fill=COLOR_TEXT, font=_F_MID)
+        d.line((48, y+40, CARD_W-48, y+40), fill=COLOR_ACCENT, width=2)
 
-    # 30 days
-    y = 320
-    d.text((48, y), "За 30 дней", fill=COLOR_TEXT, font=f_mid)
-    d.text((300, y), f"Спорт: {s30['sport']} • Продаж: {s30['sales']} • Касса: {fmt_money(s30['cash'])}", fill=COLOR_TEXT, font=f_mid)
-    d.line((48, y+40, CARD_W-48, y+40), fill=COLOR_ACCENT, width=2)
+    d.text((48, CARD_H-70), "Баланс — это ритм твоей жизни.", fill=COLOR_TEXT, font=_F_SM)
+    return img
 
-    d.text((48, CARD_H-70), "Баланс — это ритм твоей жизни.", fill=COLOR_TEXT, font=f_sm)
+# Everything except the stats lines is identical on every card: draw it once
+_CARD_BASE = _build_card_base() if Image is not None else None
 
-    cards_dir = os.path.join(BASE_DIR, "data", "cards")
-    os.makedirs(cards_dir, exist_ok=True)
-    img.save(path)
-    return path
+def card_line(s:dict)->str:
+    return f"Спорт: {s['sport']} • Продаж: {s['sales']} • Касса: {fmt_money(s['cash'])}"
+
+def render_card(s7:dict, s30:dict)->io.BytesIO:
+    img = _CARD_BASE.copy()
+    d = ImageDraw.Draw(img)
+    d.text((300, 250), card_line(s7), fill=COLOR_TEXT, font=_F_MID)
+    d.text((300, 320), card_line(s30), fill=COLOR_TEXT, font=_F_MID)
+    # Short-lived card: DEFLATE level 1 costs a few KB but most of the encode CPU
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=False, compress_level=1)
+    buf.seek(0)
+    return buf
+
+# The card depends only on the two stats windows: while they are unchanged a
+# repeat /report re-sends the cached PNG bytes and skips Pillow entirely.
+CARD_CACHE_SIZE = 256
+_CARDS: OrderedDict[int, tuple[tuple, bytes]] = OrderedDict()
+_CARDS_LOCK = threading.Lock()
+
+def get_report_card(uid:int)->bytes:
+    s7, s30 = get_stats_pair(uid, 7, 30)
+    key = (tuple(s7.values()), tuple(s30.values()))
+    with _CARDS_LOCK:
+        hit = _CARDS.get(uid)
+        if hit is not None and hit[0] == key:
+            _CARDS.move_to_end(uid)
+            return hit[1]
+    png = render_card(s7, s30).getvalue()
+    with _CARDS_LOCK:
+        _CARDS[uid] = (key, png)
+        _CARDS.move_to_end(uid)
+        while len(_CARDS) > CARD_CACHE_SIZE:
+            _CARDS.popitem(last=False)
+    return png
 
 # ----------------- Handlers -----------------
+# DB helpers block on _DB_LOCK/_AGG_LOCK, which worker threads also hold, so
+# handlers always call them through asyncio.to_thread.
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    ensure_user(uid)
+    await asyncio.to_thread(ensure_user, uid)
     txt = (
         "Привет! Я — Спутник дня.\n"
         "Помогаю держать баланс: тело × дело × душа.\n\n"
@@ -189,20 +458,32 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(txt)
     # send logo
-    try:
-        with open(os.path.join(BASE_DIR, "assets", "logo.png"), "rb") as f:
-            await update.message.reply_photo(photo=f, caption="Спутник дня — твой баланс на орбите дня.")
-    except Exception:
-        pass
+    if _LOGO_BYTES is not None:
+        try:
+            await update.message.reply_photo(photo=_LOGO_BYTES, caption="Спутник дня — твой баланс на орбите дня.")
+        except Exception:
+            pass
+
+# One lock per user around everything that touches onb_state (on_text, /onboard).
+# Weak values: a user's lock lives only while some handler holds it.
+_USER_LOCKS: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+def _user_lock(uid:int)->asyncio.Lock:
+    lock = _USER_LOCKS.get(uid)
+    if lock is None:
+        lock = _USER_LOCKS[uid] = asyncio.Lock()
+    return lock
 
 # Onboarding simplified
 ONB_TZ, ONB_TYPES, ONB_THRESH, ONB_NOTIFY = range(4)
 
 async def onboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    ensure_user(uid)
-    context.user_data["onb_state"] = ONB_TZ
-    await update.message.reply_text("Шаг 1/4: Введи часовой пояс (пример: Asia/Yekaterinburg).")
+    async with _user_lock(uid):
+        # state first, so a text sent right after /onboard is treated as step 1
+        context.user_data["onb_state"] = ONB_TZ
+        await asyncio.to_thread(ensure_user, uid)
+        await update.message.reply_text("Шаг 1/4: Введи часовой пояс (пример: Asia/Yekaterinburg).")
 
 async def onboard_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -212,14 +493,11 @@ async def onboard_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
 
     if state == ONB_TZ:
-        try:
-            pytz.timezone(text)
-        except Exception:
+        tz = _TZ_BY_LOWER.get(text.lower())
+        if tz is None:
             await update.message.reply_text("Не понял такой часовой пояс. Пример: Asia/Yekaterinburg")
             return
-        conn=get_conn(); cur=conn.cursor()
-        cur.execute("UPDATE users SET tz=? WHERE user_id=?", (text, uid))
-        conn.commit(); conn.close()
+        await asyncio.to_thread(set_tz, uid, tz)
         context.user_data["onb_state"] = ONB_TYPES
         await update.message.reply_text("Шаг 2/4: Введи виды тренировок через запятую (например: зал, бассейн, теннис).")
         return
@@ -229,11 +507,7 @@ async def onboard_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not types:
             await update.message.reply_text("Добавь хотя бы один вид, пример: зал, бассейн")
             return
-        conn=get_conn(); cur=conn.cursor()
-        cur.execute("DELETE FROM sport_types WHERE user_id=?", (uid,))
-        for name in types:
-            cur.execute("INSERT INTO sport_types(user_id,name) VALUES(?,?)",(uid,name))
-        conn.commit(); conn.close()
+        await asyncio.to_thread(set_sport_types, uid, types)
         context.user_data["onb_state"] = ONB_THRESH
         await update.message.reply_text("Шаг 3/4: Введи минимальную сумму продажи для очков (напр. 100000). 0 — очки за любую продажу.")
         return
@@ -241,10 +515,10 @@ async def onboard_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state == ONB_THRESH:
         try:
             val = int(text)
-        except:
+        except ValueError:
             await update.message.reply_text("Нужно число в рублях. Пример: 100000 или 0.")
             return
-        set_sale_threshold(uid, val)
+        await asyncio.to_thread(set_sale_threshold, uid, val)
         context.user_data["onb_state"] = ONB_NOTIFY
         await update.message.reply_text("Шаг 4/4: Включить напоминания и автоотчёты? (да/нет)")
         return
@@ -252,87 +526,115 @@ async def onboard_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state == ONB_NOTIFY:
         ans = text.lower()
         on = ans in ("да","yes","y","+","вкл","on","конечно")
-        conn=get_conn(); cur=conn.cursor()
-        cur.execute("UPDATE users SET notify=? WHERE user_id=?", (1 if on else 0, uid))
-        conn.commit(); conn.close()
+        await asyncio.to_thread(set_notify, uid, on)
         context.user_data.pop("onb_state", None)
         await update.message.reply_text("Готово! Используй /log для действий и /report для карточки.")
         return
 
 async def log_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    ensure_user(uid)
+    await asyncio.to_thread(ensure_user, uid)
     await update.message.reply_text(
         "Что записать?\n"
         "Напиши одно из:\n"
         "спорт\nзвонок\nактивность\nпродажа 120000\nкасса 50000\nсон 7\nмедитация 15\nкнига 20"
     )
 
-async def log_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    text = update.message.text.strip().lower()
-    if text == "спорт":
-        log_action(uid, "sport", None, None)
-        await update.message.reply_text(f"Тренировка записана (+{POINTS_TRAIN} очка).")
-        return
-    if text == "звонок":
-        log_action(uid, "call", None, None)
-        await update.message.reply_text("Звонок записан.")
+# One match per message instead of a chain of == / startswith / split().
+# Plain kinds must be the whole message; numeric kinds keep the old
+# startswith + "second word is a number" behaviour.
+_LOG_RE = re.compile(r"^(?:(спорт|звонок|активность)$|(продажа|касса|сон|медитация|книга)\S*(?:\s+(\d+)(?!\S))?)")
+
+async def _log_sport(update: Update, uid:int, n:int|None):
+    await asyncio.to_thread(log_action, uid, "sport", None, None)
+    await update.message.reply_text(f"Тренировка записана (+{POINTS_TRAIN} очка).")
+
+async def _log_call(update: Update, uid:int, n:int|None):
+    await asyncio.to_thread(log_action, uid, "call", None, None)
+    await update.message.reply_text("Звонок записан.")
+
+async def _log_act(update: Update, uid:int, n:int|None):
+    await asyncio.to_thread(log_action, uid, "act", None, None)
+    await update.message.reply_text("Проявленность записана.")
+
+async def _log_sale(update: Update, uid:int, n:int|None):
+    if n is None:
+        await update.message.reply_text("Формат: продажа 120000")
         return
-    if text == "активность":
-        log_action(uid, "act", None, None)
-        await update.message.reply_text("Проявленность записана.")
+    thr = await asyncio.to_thread(get_sale_threshold, uid)
+    pts = POINTS_SALE if n >= thr else 0
+    await asyncio.to_thread(log_action, uid, "sale", n, None)
+    await update.message.reply_text(f"Продажа {n} ₽. Очки: {pts}.")
+
+async def _log_cash(update: Update, uid:int, n:int|None):
+    if n is None:
+        await update.message.reply_text("Формат: касса 50000")
         return
-    if text.startswith("продажа"):
-        parts = text.split()
-        if len(parts)>=2 and parts[1].isdigit():
-            amount = int(parts[1])
-            thr = get_sale_threshold(uid)
-            pts = POINTS_SALE if amount >= thr else 0
-            log_action(uid, "sale", amount, None)
-            await update.message.reply_text(f"Продажа {amount} ₽. Очки: {pts}.")
-        else:
-            await update.message.reply_text("Формат: продажа 120000")
+    await asyncio.to_thread(log_action, uid, "cash", n, None)
+    await update.message.reply_text(f"Касса +{n} ₽.")
+
+async def _log_sleep(update: Update, uid:int, n:int|None):
+    if n is None: return
+    await asyncio.to_thread(log_action, uid, "sleep", n, None)
+    await update.message.reply_text(f"Сон {n} ч записан.")
+
+async def _log_med(update: Update, uid:int, n:int|None):
+    if n is None: return
+    await asyncio.to_thread(log_action, uid, "med", n, None)
+    await update.message.reply_text(f"Медитация {n} мин записана.")
+
+async def _log_read(update: Update, uid:int, n:int|None):
+    if n is None: return
+    await asyncio.to_thread(log_action, uid, "read", n, None)
+    await update.message.reply_text(f"Чтение {n} мин записано.")
+
+_LOG_DISPATCH = {
+    "спорт": _log_sport,
+    "звонок": _log_call,
+    "активность": _log_act,
+    "продажа": _log_sale,
+    "касса": _log_cash,
+    "сон": _log_sleep,
+    "медитация": _log_med,
+    "книга": _log_read,
+}
+
+async def log_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    m = _LOG_RE.match(update.message.text.strip().lower())
+    if not m:
         return
-    if text.startswith("касса"):
-        parts = text.split()
-        if len(parts)>=2 and parts[1].isdigit():
-            amount = int(parts[1]); log_action(uid, "cash", amount, None)
-            await update.message.reply_text(f"Касса +{amount} ₽.")
+    n = int(m.group(3)) if m.group(3) else None
+    await _LOG_DISPATCH[m.group(1) or m.group(2)](update, uid, n)
+
+# Single entry point for plain text: PTB runs only the first matching handler of a
+# group, so a second TEXT handler next to onboarding would never fire.
+async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # one message per user at a time: a double-sent sale must not race the
+    # onboarding state or interleave its writes; other users are not blocked
+    async with _user_lock(update.effective_user.id):
+        if "onb_state" in context.user_data:
+            await onboard_text(update, context)
         else:
-            await update.message.reply_text("Формат: касса 50000")
-        return
-    if text.startswith("сон"):
-        parts = text.split()
-        if len(parts)>=2 and parts[1].isdigit():
-            hours = int(parts[1]); log_action(uid, "sleep", hours, None)
-            await update.message.reply_text(f"Сон {hours} ч записан.")
-        return
-    if text.startswith("медитация"):
-        parts = text.split()
-        if len(parts)>=2 and parts[1].isdigit():
-            mins = int(parts[1]); log_action(uid, "med", mins, None)
-            await update.message.reply_text(f"Медитация {mins} мин записана.")
-        return
-    if text.startswith("книга"):
-        parts = text.split()
-        if len(parts)>=2 and parts[1].isdigit():
-            mins = int(parts[1]); log_action(uid, "read", mins, None)
-            await update.message.reply_text(f"Чтение {mins} мин записано.")
-        return
+            await log_text(update, context)
 
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    cards_dir = os.path.join(BASE_DIR, "data", "cards")
-    os.makedirs(cards_dir, exist_ok=True)
-    p = os.path.join(cards_dir, f"report_{uid}.png")
-    render_card(uid, p)
-    with open(p, "rb") as f:
-        await update.message.reply_photo(photo=f, caption="Отчёт Спутника дня.")
+    if _CARD_BASE is None:
+        s7, s30 = await asyncio.to_thread(get_stats_pair, uid, 7, 30)
+        await update.message.reply_text(
+            "Отчёт Спутника дня\n"
+            f"За 7 дней: {card_line(s7)}\n"
+            f"За 30 дней: {card_line(s30)}"
+        )
+        return
+    # Pillow + SQLite are blocking; keep the event loop free for other users
+    png = await asyncio.to_thread(get_report_card, uid)
+    await update.message.reply_photo(photo=png, caption="Отчёт Спутника дня.")
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    s30 = get_stats(uid, 30)
+    s30 = await asyncio.to_thread(get_stats, uid, 30)
     txt = (
         "Статистика за 30 дней:\n"
         f"Спорт: {s30['sport']}\n"
@@ -343,11 +645,15 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(txt)
 
 # ----------------- App -----------------
+async def post_init(app: Application):
+    await asyncio.to_thread(warm_caches)
+
 def build_app()->Application:
     if not TOKEN:
         raise RuntimeError("TELEGRAM_TOKEN is not set")
     init_db()
-    app = Application.builder().token(TOKEN).build()
+    # Updates from different users run concurrently; on_text serializes per user
+    app = Application.builder().token(TOKEN).concurrent_updates(True).post_init(post_init).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("onboard", onboard))
@@ -355,8 +661,7 @@ def build_app()->Application:
     app.add_handler(CommandHandler("report", report))
     app.add_handler(CommandHandler("stats", stats))
 
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, onboard_text))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_text))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     return app
 
 def main():